@@ -1,13 +1,25 @@
+import atexit
+import hashlib
+import json
+import signal
+import stat
 import sys
-import time
+import threading
 import logging
 import os
 import subprocess
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import PurePosixPath
 from notifypy import Notify
-from typing import Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler, LoggingEventHandler
+from watchdog.observers.api import ObservedWatch
+from watchdog.utils import UnsupportedLibc
+from watchdog.events import (
+    EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MOVED,
+    FileCreatedEvent, PatternMatchingEventHandler
+)
 
 """
 ObsESsively watches your filesystem for node-related files to compile.
@@ -17,50 +29,307 @@ Find me at https://github.com/skytreader/besessen
 
 logging.getLogger().setLevel(int(os.environ.get("BESLL", logging.INFO)))
 
-class CompileEventHandler(FileSystemEventHandler, ABC):
+try:
+    from watchdog.observers.inotify_buffer import InotifyBuffer
+    # An IN_MOVED_FROM whose IN_MOVED_TO did not come in the same read is
+    # held for half a second in case its other half shows up. Don't wait: a
+    # move that is not paired right away just arrives as a delete and a
+    # create, which our handlers deal with just fine. Moves paired within a
+    # read still arrive as moves, see on_moved.
+    InotifyBuffer.delay = 0
+except (ImportError, OSError, UnsupportedLibc):
+    # Not on Linux.
+    pass
+
+def _ext_of(fname: str) -> str:
+    """
+    Everything from the last "." of `fname`. Cheaper than os.path.splitext and
+    enough for looking up extensions in a dict.
+    """
+    return fname[fname.rfind("."):]
+
+def _walk_files(top: str, skip_dirs: Iterable[str]):
+    """
+    Yields a DirEntry for every non-directory under `top`, never descending
+    into directories named in `skip_dirs`.
+
+    The DirEntry objects from os.scandir already know their type, so this
+    saves the stat per entry that os.walk does.
+    """
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = os.scandir(dirpath)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in skip_dirs:
+                        stack.append(entry.path)
+                else:
+                    yield entry
+
+class CompileEventHandler(PatternMatchingEventHandler, ABC):
+
+    # How long events must be quiet before we compile what changed. Editors
+    # tend to fire several events for a single save, and checkouts touch many
+    # files at once.
+    DEBOUNCE_SECS = 0.2
+
+    # Notifications sent within this long of each other go out as one.
+    NOTIF_DEBOUNCE_SECS = 0.5
+
+    # Never look for sources under these.
+    IGNORED_DIRS = ("node_modules", ".git")
+
+    CACHE_DIR = "node_modules/.cache"
 
     def __init__(self, build_dir=None, file_exts=()):
-        super(CompileEventHandler, self).__init__()
         self.build_dir = build_dir[0:-1] if build_dir and build_dir[-1] == "/" else build_dir
         self.extensions: Tuple[str, ...] = tuple(
             (x if x.startswith(".") else "." + x) for x in file_exts
         )
+        self._build_dir_path = PurePosixPath(self.build_dir) if self.build_dir else None
+        self._skip_dirs: Tuple[str, ...] = self.IGNORED_DIRS + (
+            (self.build_dir,) if self.build_dir else ()
+        )
+        # Let watchdog drop irrelevant events before they reach our handlers.
+        super(CompileEventHandler, self).__init__(
+            patterns=["*" + ext for ext in self.extensions],
+            ignore_patterns=["*/%s/*" % d for d in self._skip_dirs],
+            ignore_directories=True,
+            case_sensitive=True
+        )
         # Set this property for the extension of the compiled files.
         self._compiles_to_ext: str = ""
+        self._pending_batch: Set[str] = set()
+        # Sources whose compiled output is to be removed.
+        self._pending_deletes: Set[str] = set()
+        # Sources currently being compiled by the pool.
+        self._inflight: Set[str] = set()
+        self._pool = ThreadPoolExecutor(max_workers=max(2, os.cpu_count() or 1))
+        self._batch_timer: Optional[threading.Timer] = None
+        self._closed = False
+        # Made on first use and reused after, since a Notify is costly to set up.
+        self._notify: Optional[Notify] = None
+        self._notifs: List[Tuple[str, str]] = []
+        self._notif_timer: Optional[threading.Timer] = None
+        self._notif_lock = threading.Lock()
+        # self._notify is shared so only one send may be underway at a time.
+        self._notify_send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # Digests of sources as of their last compile, so rewriting a file
+        # with the same contents does not trigger a compile.
+        self._hashes: Dict[str, str] = {}
+        self._hashes_file = "%s/besessen-hashes-%s.json" % (
+            self.CACHE_DIR, type(self).__name__.lower()
+        )
+        try:
+            with open(self._hashes_file) as hashes:
+                self._hashes = json.load(hashes)
+        except (OSError, ValueError):
+            pass
 
         if build_dir is not None:
-            if os.path.exists(self.build_dir):
-                if not os.path.isdir(self.build_dir):
+            try:
+                if not stat.S_ISDIR(os.stat(self.build_dir).st_mode):
                     logging.error("Given build dir (%s) is not a directory." % (self.build_dir))
-            else:
+            except FileNotFoundError:
                 logging.info("No build directory found. Building for the first time...")
-                os.mkdir(self.build_dir)
+                os.makedirs(self.build_dir, exist_ok=True)
 
-    def _compile_all(self):
-        for dirpath, dirnames, filenames in os.walk("."):
-            split_path = dirpath.split(os.sep)
-            if len(split_path) > 1:
-                if dirpath.split(os.sep)[1] == "node_modules":
-                    continue
+    def _bootstrap(self, srcs: Iterable[str]) -> List[Future]:
+        """
+        Starts compiling whichever of `srcs` are out of date on the pool, one
+        job per chunk from `_split_work`. Returns the jobs' futures.
+        """
+        srcs = [
+            src for src in srcs
+            if self._is_stale(src) and not self.__is_unchanged(src)
+        ]
+        return [
+            self._pool.submit(self.__guarded_compile_many, chunk)
+            for chunk in self._split_work(srcs)
+        ]
 
-            for name in filenames:
-                if self.__should_observe(name):
-                    fullfilename = os.path.join(dirpath, name)
-                    self.compile(fullfilename)
+    def _split_work(self, srcs: List[str]) -> List[List[str]]:
+        """
+        Splits `srcs` into chunks that can be compiled independently of each
+        other. By default every source is its own chunk.
+        """
+        return [[src] for src in srcs]
 
-    def __should_observe(self, fname):
-        for extension in self.extensions:
-            if fname.endswith(extension):
-                return True
+    def _is_stale(self, src):
+        """
+        Whether `src` needs to be compiled during the startup sweep. Override
+        this if the compiler has a way of knowing it is already up-to-date.
+        """
+        return True
+
+    def __is_unchanged(self, src):
+        """
+        Whether `src` has the same contents as when it was last compiled.
+        Records the new digest if not.
+        """
+        try:
+            with open(src, "rb") as f:
+                digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        except OSError:
+            return False
+        if self._hashes.get(src) == digest and (
+            not self.build_dir or os.path.exists(self._change_extension(src))
+        ):
+            return True
+        self._hashes[src] = digest
         return False
 
+    def _failure_output(self, err):
+        """
+        What to report for a failed compiler run: its output if it ran, or the
+        reason it could not be started (e.g., the compiler is not installed).
+        """
+        if isinstance(err, subprocess.CalledProcessError):
+            return (err.stdout + err.stderr).decode(errors="replace")
+        return str(err)
+
+    def _forget_hash(self, src):
+        """
+        Call this when compiling `src` failed so the next event for it is not
+        skipped.
+        """
+        self._hashes.pop(src, None)
+
+    def close(self):
+        """
+        Compiles whatever is still pending, waits for running compiles and
+        persists the source digests so the next run can skip unchanged files.
+        """
+        with self._lock:
+            self._closed = True
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+        self.__flush()
+        self._pool.shutdown(wait=True)
+        # Left pending because they were busy during the flush above.
+        with self._lock:
+            deletes, self._pending_deletes = self._pending_deletes, set()
+            batch, self._pending_batch = self._pending_batch, set()
+        for src in sorted(deletes):
+            self.__delete(self._change_extension(src))
+        if batch:
+            self.__safe_compile(sorted(batch))
+        os.makedirs(self.CACHE_DIR, exist_ok=True)
+        with open(self._hashes_file, "w") as hashes:
+            json.dump(self._hashes, hashes)
+
+        # Report on the compiles above rather than leave it to a timer that
+        # will not outlive us.
+        with self._notif_lock:
+            if self._notif_timer is not None:
+                self._notif_timer.cancel()
+                self._notif_timer = None
+        try:
+            self.__flush_notifs()
+        except Exception:
+            logging.exception("could not send notifications")
+
+    def __should_observe(self, fname):
+        return fname.endswith(self.extensions)
+
     @abstractmethod
     def compile(self, src):
         pass
+
+    def compile_many(self, srcs: Iterable[str]):
+        """
+        Compile all of `srcs`. Override this if the compiler can handle
+        several files in one go.
+        """
+        for src in srcs:
+            self.compile(src)
     
     def __delete(self, fname):
-        subprocess.call(["rm", fname])
-        logging.info("deleted %s" % fname)
+        try:
+            os.unlink(fname)
+            logging.info("deleted %s" % fname)
+        except OSError as ose:
+            logging.error("could not delete %s: %s" % (fname, ose))
+
+    def __schedule(self, path):
+        with self._lock:
+            self._pending_batch.add(path)
+            self.__arm_batch()
+
+    def __schedule_delete(self, src):
+        """
+        Queue removal of the compiled output of `src`, dropping any compile of
+        it still pending.
+        """
+        with self._lock:
+            self._pending_batch.discard(src)
+            self._pending_deletes.add(src)
+            self.__arm_batch()
+
+    def __arm_batch(self):
+        # Caller must hold self._lock.
+        if self._closed:
+            return
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+        self._batch_timer = threading.Timer(self.DEBOUNCE_SECS, self.__flush_batch)
+        self._batch_timer.daemon = True
+        self._batch_timer.start()
+
+    def __flush_batch(self):
+        with self._lock:
+            if self._batch_timer is not threading.current_thread():
+                return
+            self._batch_timer = None
+        self.__flush()
+
+    def __flush(self):
+        with self._lock:
+            # Anything still compiling stays pending until that compile is
+            # done, so the same source never compiles twice at once and its
+            # output is not removed only for the compile to write it back.
+            busy_deletes = self._pending_deletes & self._inflight
+            deletes = self._pending_deletes - busy_deletes
+            self._pending_deletes = busy_deletes
+            busy = self._pending_batch & self._inflight
+            batch = self._pending_batch - busy
+            self._pending_batch = busy
+            self._inflight |= batch
+        for src in sorted(deletes):
+            self.__delete(self._change_extension(src))
+        if batch:
+            self._pool.submit(self.__safe_compile, sorted(batch))
+
+    def __guarded_compile_many(self, srcs):
+        """
+        `compile_many`, but errors the compiler did not handle itself are
+        logged and notified instead of raised.
+        """
+        try:
+            self.compile_many(srcs)
+        except Exception as e:
+            logging.exception("error while compiling %s" % " ".join(srcs))
+            for src in srcs:
+                self._forget_hash(src)
+            self.send_notif("failure: %s" % " ".join(srcs), str(e))
+
+    def __safe_compile(self, srcs):
+        try:
+            changed = [src for src in srcs if not self.__is_unchanged(src)]
+            if changed:
+                self.__guarded_compile_many(changed)
+        finally:
+            with self._lock:
+                self._inflight.difference_update(srcs)
+                if self._pending_batch or self._pending_deletes:
+                    self.__arm_batch()
 
     def __is_filesys_ev(self, event):
         return not event.is_directory and self.__should_observe(event.src_path)
@@ -69,92 +338,237 @@ class CompileEventHandler(FileSystemEventHandler, ABC):
         super(CompileEventHandler, self).on_created(event)
         if self.__is_filesys_ev(event):
             logging.debug("detected created event %s" % event)
-            self.compile(event.src_path)
+            self.__schedule(event.src_path)
 
     def on_deleted(self, event):
         super(CompileEventHandler, self).on_deleted(event)
         if self.__is_filesys_ev(event):
             logging.debug("detected delete event %s" % event)
-            self.__delete(self._change_extension(event.src_path))
+            self.__schedule_delete(event.src_path)
 
     def on_modified(self, event):
         super(CompileEventHandler, self).on_modified(event)
         if self.__is_filesys_ev(event):
             logging.debug("detected modified event %s" % event)
-            self.compile(event.src_path)
+            self.__schedule(event.src_path)
 
     def on_moved(self, event):
         """
-        This assumes that you did not move a ".js" file to something of another
-        extension.
+        Either side of the move may be something we do not watch. Editors
+        that save atomically, for one, write a temporary file and move it over
+        the source.
         """
         super(CompileEventHandler, self).on_moved(event)
-        if self.__is_filesys_ev(event):
-            logging.debug("detected moved event %s" % event)
-            self.__delete(self._change_extension(event.src_path))
-            if self.__should_observe(event.dest_path):
-                self.compile(event.dest_path)
+        if event.is_directory:
+            return
+        logging.debug("detected moved event %s" % event)
+        if self.__should_observe(event.src_path):
+            self.__schedule_delete(event.src_path)
+        if self.__should_observe(event.dest_path):
+            self.__schedule(event.dest_path)
 
     def _change_extension(self, filename):
         """
-        Changes the extension of `filename` to `newext`.
+        Changes the extension of `filename` to `_compiles_to_ext` and places
+        it directly under the build dir, if there is one.
         """
         newext = self._compiles_to_ext if self._compiles_to_ext[0] == "." else "." + self._compiles_to_ext
-        filename_parse = filename.split(".")
-        sans_extension = ".".join(filename_parse[0:-1])
-        if self.build_dir:
-            sans_extension_parse = sans_extension.split("/")
-            sans_extension_parse[-2] = self.build_dir
-            sans_extension = "/".join(sans_extension_parse)
-        return sans_extension + newext
+        p = PurePosixPath(filename)
+        parent = self._build_dir_path if self._build_dir_path else p.parent
+        return str(parent / (p.stem + newext))
 
     def send_notif(self, title, msg):
-        n = Notify()
-        n.title = title
-        n.message = msg
-        n.send()
+        with self._notif_lock:
+            self._notifs.append((title, msg))
+            if self._notif_timer is None:
+                self._notif_timer = threading.Timer(
+                    self.NOTIF_DEBOUNCE_SECS, self.__flush_notifs
+                )
+                self._notif_timer.daemon = True
+                self._notif_timer.start()
+
+    def __flush_notifs(self):
+        with self._notif_lock:
+            notifs, self._notifs = self._notifs, []
+            self._notif_timer = None
+
+        if not notifs:
+            return
+        elif len(notifs) == 1:
+            title, msg = notifs[0]
+        else:
+            title = "%d compiler notifications" % len(notifs)
+            msg = "\n".join("%s: %s" % notif for notif in notifs)
+
+        with self._notify_send_lock:
+            if self._notify is None:
+                self._notify = Notify()
+            self._notify.title = title
+            self._notify.message = msg
+            self._notify.send()
 
 class TSCompiler(CompileEventHandler):
 
-    def __init__(self, build_dir):
+    def __init__(self, build_dir, watch=False):
+        """
+        If `watch` is set, a single long-lived `tsc --watch` does all the work
+        and this handler need not be scheduled on an observer. That requires a
+        tsconfig.json since tsc is not given any files.
+        """
         super().__init__(build_dir, ("ts",))
         self._compiles_to_ext = ".js"
-        self._compile_all()
+        os.makedirs(self.CACHE_DIR, exist_ok=True)
+        # One per source dir, so two tsc runs never share a buildinfo file.
+        self._dir_locks: Dict[str, threading.Lock] = {}
+        self.proc = None
+        if watch:
+            self._start_watch()
+
+    def _start_watch(self):
+        self.proc = subprocess.Popen(
+            [
+                "./node_modules/typescript/bin/tsc", "--watch", "--incremental",
+                "--preserveWatchOutput", "--listEmittedFiles",
+                "--tsBuildInfoFile", "%s/besessen.tsbuildinfo" % self.CACHE_DIR,
+                "--outDir", self.build_dir, "--lib", "es2015,es2015.iterable,dom"
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True
+        )
+        atexit.register(self.stop_watch)
+        threading.Thread(target=self._read_watch, daemon=True).start()
+        logging.info("Started tsc --watch (pid %s)" % self.proc.pid)
+
+    def _read_watch(self):
+        errors = []
+        for line in self.proc.stdout:
+            line = line.rstrip()
+            if not line:
+                continue
+            logging.debug("tsc: %s" % line)
+            if line.startswith("TSFILE: "):
+                logging.info("emitted %s" % line[len("TSFILE: "):])
+            elif "error TS" in line:
+                errors.append(line)
+            elif "Found 0 errors" in line:
+                errors = []
+                self.send_notif("tsc", "compiled to %s" % self.build_dir)
+            elif "Found " in line and " error" in line:
+                logging.error("\n".join(errors))
+                self.send_notif("failure: tsc", "\n".join(errors) or line)
+                errors = []
+
+    def stop_watch(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+    def _buildinfo_file(self, srcdir):
+        """
+        Where tsc keeps its incremental state for sources in `srcdir`.
+        """
+        key = hashlib.blake2b(
+            os.path.normpath(srcdir).encode(), digest_size=8
+        ).hexdigest()
+        return "%s/besessen-%s.tsbuildinfo" % (self.CACHE_DIR, key)
+
+    def _is_stale(self, src):
+        """
+        Both tsc's incremental state and the compiled output must be newer than
+        `src`. tsc writes its buildinfo even when compiling fails, so that
+        alone does not mean there is anything to show for it.
+        """
+        try:
+            src_mtime = os.path.getmtime(src)
+            buildinfo = self._buildinfo_file(os.path.dirname(src))
+            return (
+                os.path.getmtime(buildinfo) < src_mtime or
+                os.path.getmtime(self._change_extension(src)) < src_mtime
+            )
+        except OSError:
+            return True
     
     def compile(self, src):
-        outfile = self._change_extension(src)
+        self.compile_many((src,))
+
+    def compile_many(self, srcs):
+        """
+        Runs one tsc per source directory, rooted at that directory so every
+        source `foo.ts` compiles to its own `<build_dir>/foo.js`, as
+        `_change_extension` expects. Unlike the `--outFile` per source this
+        used to use, files a source references are not bundled into its output;
+        tsc reports referenced files outside the source's directory as errors.
+        """
+        for group in self._split_work(srcs):
+            self.__compile_group(os.path.dirname(group[0]), group)
+
+    def _split_work(self, srcs):
+        by_dir = {}
+        for src in srcs:
+            by_dir.setdefault(os.path.dirname(src), []).append(src)
+        return list(by_dir.values())
+
+    def __dir_lock(self, srcdir):
+        with self._lock:
+            return self._dir_locks.setdefault(srcdir, threading.Lock())
+
+    def __compile_group(self, srcdir, srcs):
+        with self.__dir_lock(srcdir):
+            if not all(os.path.exists(self._change_extension(src)) for src in srcs):
+                # An incremental tsc only emits what differs from its
+                # buildinfo, never mind whether the output is still there.
+                # Without the buildinfo it emits everything it is given.
+                try:
+                    os.unlink(self._buildinfo_file(srcdir))
+                except FileNotFoundError:
+                    pass
+            self.__run_tsc(srcdir, srcs)
+
+    def __run_tsc(self, srcdir, srcs):
+        title = srcs[0] if len(srcs) == 1 else "%d files in %s" % (len(srcs), srcdir)
         try:
-            subprocess.check_output(
-                "./node_modules/typescript/bin/tsc --lib es2015,es2015.iterable,dom --outFile %s %s" % (outfile, src),
-                shell=True
+            subprocess.run(
+                [
+                    "./node_modules/typescript/bin/tsc", "--lib", "es2015,es2015.iterable,dom",
+                    "--incremental", "--tsBuildInfoFile", self._buildinfo_file(srcdir),
+                    "--rootDir", srcdir or os.curdir, "--outDir", self.build_dir
+                ] + srcs,
+                check=True,
+                capture_output=True
             )
-            logging.info("compiled %s to %s" % (src, outfile))
-            self.send_notif(src, "compiled to %s" % outfile)
-        except subprocess.CalledProcessError as cpe:
-            logging.error("failed to compile %s" % src)
-            logging.error(cpe.output)
-            self.send_notif("failure: %s" % src, cpe.output)
+            for src in srcs:
+                logging.info("compiled %s to %s" % (src, self._change_extension(src)))
+            self.send_notif(title, "compiled to %s" % self.build_dir)
+        except (subprocess.CalledProcessError, OSError) as err:
+            logging.error("failed to compile %s" % " ".join(srcs))
+            for src in srcs:
+                self._forget_hash(src)
+            output = self._failure_output(err)
+            logging.error(output)
+            self.send_notif("failure: %s" % title, output)
 
 class LessCompiler(CompileEventHandler):
 
     def __init__(self, build_dir):
         super().__init__(build_dir, ("less",))
         self._compiles_to_ext = ".css"
-        self._compile_all()
 
     def compile(self, src):
         outfile = self._change_extension(src)
         try:
-            subprocess.check_output(
-                "./node_modules/less/bin/lessc %s %s" % (src, outfile),
-                shell=True
+            subprocess.run(
+                ["./node_modules/less/bin/lessc", src, outfile],
+                check=True,
+                capture_output=True
             )
             logging.info("compiled %s to %s" % (src, outfile))
             self.send_notif(src, "compiled to %s" % outfile)
-        except subprocess.CalledProcessError as cpe:
+        except (subprocess.CalledProcessError, OSError) as err:
             logging.error("failed to compile %s" % src)
-            logging.error(cpe.output)
-            self.send_notif("failure: %s" % src, cpe.output)
+            self._forget_hash(src)
+            output = self._failure_output(err)
+            logging.error(output)
+            self.send_notif("failure: %s" % src, output)
 
 # This is so custom. Maybe a plugin system?
 class JinjaCMSCompiler(CompileEventHandler):
@@ -166,20 +580,138 @@ class JinjaCMSCompiler(CompileEventHandler):
         """
         super().__init__(None, ("jinja", "j2"))
         self._compiles_to_ext = "html"
-        self._compile_all()
 
     def compile(self, src):
+        self.compile_many((src,))
+
+    def _split_work(self, srcs):
+        return [srcs] if srcs else []
+
+    def compile_many(self, srcs):
+        """
+        A cms call regenerates the whole site anyway so however many templates
+        changed, invoke it just once.
+        """
+        srcs = list(srcs)
+        title = srcs[0] if len(srcs) == 1 else "%d templates" % len(srcs)
         try:
-            subprocess.check_output(
-                "/home/chad/.virtualenvs/neocities-cms/bin/python ../cms.py cms.json",
-                shell=True
+            subprocess.run(
+                ["/home/chad/.virtualenvs/neocities-cms/bin/python", "../cms.py", "cms.json"],
+                check=True,
+                capture_output=True
             )
-            logging.info("Invoked cms for %s" % src)
-            self.send_notif(src, "Triggered a cms call.")
-        except subprocess.CalledProcessError as cpe:
-            logging.error("failed to compile %s" % src)
-            logging.error(cpe.output)
-            self.send_notif("failure: %s" % src, cpe.output)
+            logging.info("Invoked cms for %s" % " ".join(srcs))
+            self.send_notif(title, "Triggered a cms call.")
+        except (subprocess.CalledProcessError, OSError) as err:
+            logging.error("failed to compile %s" % " ".join(srcs))
+            for src in srcs:
+                self._forget_hash(src)
+            output = self._failure_output(err)
+            logging.error(output)
+            self.send_notif("failure: %s" % title, output)
+
+class MultiCompiler(PatternMatchingEventHandler):
+    """
+    Routes events to the compiler registered for the file's extension, so one
+    handler serves every compiler. Also compiles whatever is out of date on
+    init, with one walk for all compilers.
+    """
+
+    def __init__(self, compilers: Iterable[CompileEventHandler], path="."):
+        self._dispatch: Dict[str, CompileEventHandler] = {
+            ext: compiler for compiler in compilers for ext in compiler.extensions
+        }
+        self._compilers = set(self._dispatch.values())
+        self._skip_dirs: Tuple[str, ...] = tuple(
+            set(d for compiler in self._compilers for d in compiler._skip_dirs)
+        )
+        super(MultiCompiler, self).__init__(
+            patterns=["*" + ext for ext in self._dispatch],
+            ignore_patterns=["*/%s/*" % d for d in self._skip_dirs],
+            ignore_directories=True,
+            case_sensitive=True
+        )
+        self._observer: Optional[Observer] = None
+        self._root = os.path.normpath(path)
+        self._watches: Dict[str, ObservedWatch] = {}
+        self.__compile_all(path)
+
+    def watch(self, observer, path):
+        """
+        Schedules this on `observer`, watching `path` itself non-recursively
+        and each of its subdirectories recursively, except the ignored ones.
+        That way inotify never has to track node_modules and the like.
+        Subdirectories created later are picked up as they appear.
+        """
+        self._observer = observer
+        observer.schedule(self, path, recursive=False)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    self.__watch_dir(entry.path, catch_up=False)
+
+    def __is_top_level(self, path):
+        return os.path.normpath(os.path.dirname(path)) == self._root
+
+    def __watch_dir(self, dirpath, catch_up=True):
+        key = os.path.normpath(dirpath)
+        if os.path.basename(key) in self._skip_dirs or key in self._watches:
+            return
+        self._watches[key] = self._observer.schedule(self, dirpath, recursive=True)
+        if catch_up:
+            # Sources may have landed in it before the watch was in place.
+            for entry in _walk_files(dirpath, self._skip_dirs):
+                self.on_any_event(FileCreatedEvent(entry.path))
+
+    def __unwatch_dir(self, dirpath):
+        watch = self._watches.pop(os.path.normpath(dirpath), None)
+        if watch is not None:
+            try:
+                self._observer.unschedule(watch)
+            except KeyError:
+                pass
+
+    def dispatch(self, event):
+        if event.is_directory and self._observer is not None:
+            src_top = self.__is_top_level(event.src_path)
+            if event.event_type == EVENT_TYPE_CREATED and src_top:
+                self.__watch_dir(event.src_path)
+            elif event.event_type == EVENT_TYPE_DELETED and src_top:
+                self.__unwatch_dir(event.src_path)
+            elif event.event_type == EVENT_TYPE_MOVED:
+                if src_top:
+                    self.__unwatch_dir(event.src_path)
+                if self.__is_top_level(event.dest_path):
+                    self.__watch_dir(event.dest_path)
+        super(MultiCompiler, self).dispatch(event)
+
+    def __compile_all(self, path):
+        srcs = {compiler: [] for compiler in self._compilers}
+        for entry in _walk_files(path, self._skip_dirs):
+            compiler = self._dispatch.get(_ext_of(entry.name))
+            if compiler is not None:
+                srcs[compiler].append(entry.path)
+
+        # Let every compiler get going before waiting on any of them.
+        futures = [
+            future for compiler, compiler_srcs in srcs.items()
+            for future in compiler._bootstrap(compiler_srcs)
+        ]
+        for future in futures:
+            future.result()
+
+    def on_any_event(self, event):
+        paths = [event.src_path]
+        if hasattr(event, "dest_path"):
+            paths.append(event.dest_path)
+        targets = set(self._dispatch.get(_ext_of(p)) for p in paths)
+        targets.discard(None)
+        for compiler in targets:
+            compiler.dispatch(event)
+
+    def close(self):
+        for compiler in self._compilers:
+            compiler.close()
 
 if __name__ == "__main__":
     logging.basicConfig(
@@ -188,14 +720,20 @@ if __name__ == "__main__":
     )
     path = sys.argv[1] if len(sys.argv) > 1 else '.'
     observer = Observer()
-    observer.schedule(TSCompiler("jsbuild"), path, recursive=True)
-    observer.schedule(LessCompiler("css"), path, recursive=True)
-    observer.schedule(JinjaCMSCompiler(), path, recursive=True)
+    # tsc --watch tracks the .ts files on its own.
+    ts_compiler = TSCompiler("jsbuild", watch=bool(os.environ.get("BESTSWATCH")))
+    compilers = [LessCompiler("css"), JinjaCMSCompiler()]
+    if ts_compiler.proc is None:
+        compilers.append(ts_compiler)
+    handler = MultiCompiler(compilers, path)
+    handler.watch(observer, path)
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
     observer.start()
     logging.info("Watching directory...")
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
+    stop.wait()
+    observer.stop()
+    ts_compiler.stop_watch()
+    handler.close()
     observer.join()